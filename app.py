@@ -1,12 +1,18 @@
 import os
+import json
 import logging
+import queue
+import threading
+import time
 import slack
 import ssl as ssl_lib
 import certifi
 from foosboi import *
+from eventlog import EventLog
 from slack import RTMClient
 from slack.errors import SlackApiError
 from slackeventsapi import SlackEventAdapter
+from flask import request, make_response
 from local_settings import *
 from sqlalchemy.orm import sessionmaker
 from typing import List
@@ -16,6 +22,115 @@ slack_events_adapter = SlackEventAdapter(slack_signing_secret, "/slack/events")
 
 slack_bot_token = SLACK_BOT_TOKEN
 
+# Seconds to wait for more changes before editing the game cards
+CARD_UPDATE_DELAY = 1.0
+
+
+class GameCards():
+    """One interactive message per open game, edited in place with chat_update.
+
+    Refreshes are debounced per channel, so a burst of joins and shuffles ends
+    up as a single round of updates, and cards whose blocks didn't change are
+    left alone.
+    """
+    def __init__(self, delay=CARD_UPDATE_DELAY):
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.cards = {}  # game id -> {"channel", "ts", "blocks", "ready"}
+        self.timers = {}  # channel -> pending refresh
+        self.flush_locks = {}  # channel -> held for the whole of a flush
+        self.messages = {}  # channel -> command results waiting for the next flush
+
+    def refresh(self, web_client: slack.WebClient, channel: str, message: str = None):
+        """Queue a card update. `message` is posted as a reply if no card ends
+        up changing, so results like "Game isn't full yet!" aren't lost."""
+        with self.lock:
+            if message:
+                self.messages.setdefault(channel, []).append(message)
+            if channel in self.timers:
+                return
+            timer = threading.Timer(self.delay, self.flush, args=(web_client, channel))
+            self.timers[channel] = timer
+        timer.start()
+
+    def flush(self, web_client: slack.WebClient, channel: str):
+        with self.lock:
+            flush_lock = self.flush_locks.setdefault(channel, threading.Lock())
+
+        # A card is only ever touched by flushes of its own channel, and those
+        # run one at a time; refreshes arriving meanwhile queue another flush.
+        with flush_lock:
+            with self.lock:
+                self.timers.pop(channel, None)
+                card_game_ids = [game_id for game_id, card in list(self.cards.items()) if card["channel"] == channel]
+
+            open_game_ids = foosboi.get_open_game_ids()
+            changed = False
+            for game_id in dict.fromkeys(open_game_ids + card_game_ids):
+                try:
+                    changed |= self.update(web_client, channel, game_id, game_id in open_game_ids)
+                except SlackApiError as e:
+                    print(f"Got an error: {e.response['error']}")
+
+            with self.lock:
+                messages = self.messages.pop(channel, [])
+                thread_ts = max((card["ts"] for card in self.cards.values()
+                                 if card["channel"] == channel and card["ts"]), default=None, key=float)
+            if changed:
+                return
+            for message in messages:
+                try:
+                    web_client.chat_postMessage(channel=channel, thread_ts=thread_ts, text=message)
+                except SlackApiError as e:
+                    print(f"Got an error: {e.response['error']}")
+
+    def update(self, web_client: slack.WebClient, channel: str, game_id: int, is_open: bool) -> bool:
+        """Post or edit the game's card; returns whether it changed."""
+        changed = False
+        with self.lock:
+            card = self.cards.get(game_id)
+            if card is not None and card["channel"] != channel:
+                return False
+            if card is None:
+                if not is_open:
+                    return False
+                # Claim the game before posting so another channel's flush doesn't post it too
+                card = self.cards[game_id] = {"channel": channel, "ts": None, "blocks": None, "ready": False}
+                is_new = True
+            else:
+                is_new = False
+
+        if is_new:
+            payload = foosboi.get_message_payload(game_id, channel=channel)
+            del payload["ts"]
+            try:
+                response = web_client.chat_postMessage(**payload)
+            except SlackApiError:
+                with self.lock:
+                    self.cards.pop(game_id, None)
+                raise
+            card["ts"] = response["ts"]
+            card["blocks"] = payload["blocks"]
+            changed = True
+        else:
+            payload = foosboi.get_message_payload(game_id, channel=card["channel"], ts=card["ts"])
+            if payload["blocks"] != card["blocks"]:
+                web_client.chat_update(**payload)
+                card["blocks"] = payload["blocks"]
+                changed = True
+
+        if not is_open:
+            with self.lock:
+                self.cards.pop(game_id, None)
+        elif not card["ready"]:
+            # Edits don't notify anyone, so ping the players once in the card's thread
+            message = foosboi.get_ready_message(game_id)
+            if message:
+                web_client.chat_postMessage(channel=card["channel"], thread_ts=card["ts"], text=message)
+                card["ready"] = True
+        return changed
+
+
 def command(f):
     def wrapped_function(*args, **kwargs):
         try:
@@ -30,14 +145,27 @@ def command(f):
             print(f"Got an error: {e.response['error']}")
     return wrapped_function
 
-@command
+def game_command(f):
+    """Like command, but the result is shown on the game cards instead of a new
+    message, unless no card changes."""
+    def wrapped_function(*args, **kwargs):
+        try:
+            message = f(*args, **kwargs)
+            web_client = args[0]
+            channel = args[1]
+            cards.refresh(web_client, channel, message)
+        except SlackApiError as e:
+            print(f"Got an error: {e.response['error']}")
+    return wrapped_function
+
+@game_command
 def start_game(web_client: slack.WebClient, channel: str, user_id: str):
     user = web_client.users_info(user=user_id)
     message = foosboi.start_game(players_info=[user])
 
     return message
 
-@command
+@game_command
 def add_players(web_client: slack.WebClient, channel: str, players: List[dict]):
     users = []
     for user_id in players:
@@ -52,22 +180,38 @@ def games(web_client: slack.WebClient, channel: str, players: List[dict]):
 
 @command
 def cancel_all_games(web_client: slack.WebClient, channel: str):
-    return foosboi.cancel_all_games()
+    message = foosboi.cancel_all_games()
+    cards.refresh(web_client, channel)
+    return message
 
 @command
 def cancel_game(web_client: slack.WebClient, channel: str, game_num: int):
-    return foosboi.cancel_game(game_num)
+    message = foosboi.cancel_game(game_num)
+    cards.refresh(web_client, channel)
+    return message
 
 @command
 def stats(web_client: slack.WebClient, channel: str):
     return foosboi.print_stats()
 
+@command
+def top_stats(web_client: slack.WebClient, channel: str, n: int):
+    return foosboi.print_top(n)
+
+@command
+def rank(web_client: slack.WebClient, channel: str, user_id:str):
+    user_id = user_id.strip('<@>')
+    user = web_client.users_info(user=user_id)
+    return foosboi.get_rank(user)
+
 @command
 def finish_game(web_client: slack.WebClient, channel: str, score:str):
     team1_score, team2_score = map(int, score.split('-'))
-    return foosboi.finish_game(team1_score, team2_score)
+    message = foosboi.finish_game(team1_score, team2_score)
+    cards.refresh(web_client, channel)
+    return message
 
-@command
+@game_command
 def shuffle(web_client: slack.WebClient, channel: str, game_num:int):
     return foosboi.shuffle(game_num)
 
@@ -86,6 +230,65 @@ def rebuy(web_client: slack.WebClient, channel: str, user_id:str):
     user = client.users_info(user=user_id)
     return foosboi.rebuy(user)
 
+# ============== Interactive Actions ============= #
+# Buttons and menus on the game cards are posted to this endpoint, which
+# should be set as the app's interactivity request URL.
+@slack_events_adapter.server.route("/slack/actions", methods=["POST"])
+def handle_action():
+    req_timestamp = request.headers.get("X-Slack-Request-Timestamp")
+    req_signature = request.headers.get("X-Slack-Signature")
+    # Same checks as the adapter's /slack/events route, so captured requests can't be replayed
+    if not req_timestamp or not req_signature:
+        return make_response("", 403)
+    try:
+        if abs(time.time() - int(req_timestamp)) > 60 * 5:
+            return make_response("", 403)
+    except ValueError:
+        return make_response("", 403)
+    if not slack_events_adapter.server.verify_signature(req_timestamp, req_signature):
+        return make_response("", 403)
+
+    try:
+        payload = json.loads(request.form["payload"])
+        channel = payload["channel"]["id"]
+        user_id = payload["user"]["id"]
+        actions = payload.get("actions", [])
+    except (KeyError, TypeError, ValueError):
+        return make_response("", 400)
+
+    # Slack gives up after 3 seconds, so acknowledge now and let the worker
+    # run the actions, in the order they were clicked
+    action_queue.put((channel, user_id, actions))
+    return make_response("", 200)
+
+
+def process_actions(channel: str, user_id: str, actions: List[dict]):
+    for action in actions:
+        message = None
+        try:
+            game_id = int(action["block_id"])
+            if action["action_id"] == "join_game":
+                message = foosboi.add_players(players_info=[client.users_info(user=user_id)], game_id=game_id)
+            elif action["action_id"] == "leave_game":
+                message = foosboi.leave_game(user_id, game_id)
+            elif action["action_id"] == "shuffle_game":
+                message = foosboi.shuffle(game_id=game_id)
+            elif action["action_id"] == "finish_game":
+                team1_score, team2_score = map(int, action["selected_option"]["value"].split('-'))
+                client.chat_postMessage(channel=channel,
+                                        text=foosboi.finish_game(team1_score, team2_score, game_id=game_id))
+        except SlackApiError as e:
+            print(f"Got an error: {e.response['error']}")
+        except Exception as e:
+            print(f"Couldn't handle action {action.get('action_id')}: {e!r}")
+        cards.refresh(client, channel, message)
+
+
+def action_worker():
+    while True:
+        process_actions(*action_queue.get())
+
+
 # ================ Team Join Event =============== #
 # When the user first joins a team, the type of the event will be 'team_join'.
 # Here we'll link the onboarding_message callback to the 'team_join' event.
@@ -142,6 +345,17 @@ def message(**payload):
         elif "finish game" in text:
             score = text.split()[2:][0]
             response = finish_game(client, channel_id, score)
+        elif text.split()[:1] == ["rank"]:
+            message_list = text.split()
+            try:
+                user = message_list[1]
+            except IndexError:
+                user = user_id
+            response = rank(client, channel_id, user)
+        elif "stats top" in text:
+            message_list = text.split()
+            n = int(message_list[2]) if len(message_list) > 2 else 10
+            response = top_stats(client, channel_id, n)
         elif "stats" in text:
             response = stats(client, channel_id)
         elif "shuffle" in text:
@@ -192,6 +406,17 @@ def handle_message(event_data):
         elif "finish game" in message.get("text"):
             score = message.get("text").split()[2:][0]
             finish_game(client, channel, score)
+        elif message.get("text").split()[:1] == ["rank"]:
+            message_list = message.get("text").split()
+            try:
+                user = message_list[1]
+            except IndexError:
+                user = message['user']
+            rank(client, channel, user)
+        elif "stats top" in message.get("text"):
+            message_list = message.get("text").split()
+            n = int(message_list[2]) if len(message_list) > 2 else 10
+            top_stats(client, channel, n)
         elif "stats" in message.get("text"):
             stats(client, channel)
         elif "shuffle" in message.get("text"):
@@ -224,10 +449,15 @@ logger.setLevel(logging.DEBUG)
 logger.addHandler(logging.StreamHandler())
 ssl_context = ssl_lib.create_default_context(cafile=certifi.where())
 slack_token = SLACK_BOT_TOKEN
-foosboi = Foosboi()
+foosboi = Foosboi(event_log=EventLog())
+cards = GameCards()
+action_queue = queue.Queue()
+threading.Thread(target=action_worker, daemon=True).start()
+client = slack.WebClient(token=slack_token, ssl=ssl_context)
+# Serves the interactivity endpoint alongside the RTM connection
+threading.Thread(target=slack_events_adapter.start, kwargs={"port": 3000}, daemon=True).start()
 rtm_client = slack.RTMClient(token=slack_token, ssl=ssl_context)
 rtm_client.start()
-#client = slack.WebClient(token=slack_token)
 
 #response = client.chat_postMessage(
 #    channel='#bottesters',
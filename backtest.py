@@ -0,0 +1,96 @@
+"""Replay the game history under a grid of TrueSkill settings and keep the
+one whose pre-game win predictions scored best.
+
+    python backtest.py
+    python backtest.py --beta 2 4.17 6 --tau 0 0.08 --workers 4 --dry-run
+"""
+import argparse
+import itertools
+import json
+import math
+from concurrent.futures import ProcessPoolExecutor
+from trueskill import TrueSkill, MU, SIGMA, BETA, TAU, DRAW_PROBABILITY
+
+from foosboi import session_scope, get_finished_results, team_win_probability, TRUESKILL_SETTINGS_FILE
+
+
+DEFAULT_BETAS = [BETA / 2, BETA * 3 / 4, BETA, BETA * 3 / 2, BETA * 2]
+DEFAULT_TAUS = [0, TAU / 2, TAU, TAU * 2, TAU * 4]
+DEFAULT_DRAW_PROBABILITIES = [0, DRAW_PROBABILITY]
+# Keeps log-loss finite when a prediction is (nearly) certain and wrong
+EPSILON = 1e-15
+
+_results = []
+
+
+def _init_worker(results):
+    global _results
+    _results = results
+
+
+def load_results():
+    with session_scope() as session:
+        return [tuple(row) for row in get_finished_results(session)]
+
+
+def score(settings):
+    """Replay every game under `settings`, scoring each prediction before the
+    result is rated. Returns (settings, log_loss, brier)."""
+    env = TrueSkill(**settings)
+    ratings = {}
+    log_loss = brier = 0.0
+
+    for t1p1, t1p2, t2p1, t2p2, t1score, t2score in _results:
+        team1 = [ratings.get(t1p1) or env.create_rating(), ratings.get(t1p2) or env.create_rating()]
+        team2 = [ratings.get(t2p1) or env.create_rating(), ratings.get(t2p2) or env.create_rating()]
+        team1_won = t1score > t2score
+
+        p = min(max(team_win_probability(env, team1, team2), EPSILON), 1 - EPSILON)
+        log_loss -= math.log(p if team1_won else 1 - p)
+        brier += ((1 if team1_won else 0) - p) ** 2
+
+        ranks = [0, 1] if team1_won else [1, 0]
+        (ratings[t1p1], ratings[t1p2]), (ratings[t2p1], ratings[t2p2]) = env.rate([team1, team2], ranks=ranks)
+
+    n = len(_results) or 1
+    return settings, log_loss / n, brier / n
+
+
+def sweep(results, betas, taus, draw_probabilities, workers=None):
+    grid = [{"mu": MU, "sigma": SIGMA, "beta": beta, "tau": tau, "draw_probability": draw}
+            for beta, tau, draw in itertools.product(betas, taus, draw_probabilities)]
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(results,)) as pool:
+        scores = list(pool.map(score, grid, chunksize=max(1, len(grid) // 32)))
+    return sorted(scores, key=lambda s: (s[1], s[2]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--beta", type=float, nargs="+", default=DEFAULT_BETAS)
+    parser.add_argument("--tau", type=float, nargs="+", default=DEFAULT_TAUS)
+    parser.add_argument("--draw-probability", type=float, nargs="+", default=DEFAULT_DRAW_PROBABILITIES)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--top", type=int, default=5, help="number of settings to print")
+    parser.add_argument("--output", default=TRUESKILL_SETTINGS_FILE)
+    parser.add_argument("--dry-run", action="store_true", help="don't write the best settings")
+    args = parser.parse_args()
+
+    results = load_results()
+    if not results:
+        print("No finished games to backtest.")
+        return
+
+    scores = sweep(results, args.beta, args.tau, args.draw_probability, args.workers)
+    print(f"{len(results)} games, {len(scores)} settings")
+    for settings, log_loss, brier in scores[:args.top]:
+        print(f"log-loss {log_loss:.4f}  brier {brier:.4f}  "
+              f"beta {settings['beta']:.3f}  tau {settings['tau']:.4f}  draw {settings['draw_probability']:.2f}")
+
+    if not args.dry_run:
+        with open(args.output, "w") as f:
+            json.dump(scores[0][0], f, indent=2)
+        print(f"Best settings written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,292 @@
+"""Append-only log of state-changing Foosboi commands, with database
+snapshots so queue and rating state can be rebuilt by replaying the tail.
+
+    python eventlog.py --db recovered.db
+    python eventlog.py --db bug.db --until 1234
+"""
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from sqlalchemy import create_engine
+
+import foosboi
+
+
+# Each snapshot starts a new log segment, foosboi.events.<seq>, holding the events after it
+EVENT_LOG_FILE = 'foosboi.events'
+SNAPSHOT_DIR = 'snapshots'
+# Events are fsynced once this many are pending, or this many seconds after the first one.
+# logged_command syncs each command before running it, so batching only
+# applies to other callers of append.
+SYNC_BATCH_SIZE = 32
+SYNC_INTERVAL = 0.05
+SNAPSHOT_EVERY = 500
+SNAPSHOTS_KEPT = 3
+
+
+class ReplayError(Exception):
+    pass
+
+
+class EventLog():
+    """JSON lines of {"seq", "time", "command", "args"}, one per command.
+
+    A command that raises gets a follow-up "failed" event naming its seq and
+    exception type. It may still have changed state before raising, so
+    replay runs it again and expects the same exception.
+
+    Every segment, and every restart, begins with a "configure" event holding
+    the TrueSkill settings in effect, since team balancing depends on them.
+    """
+    def __init__(self, path=EVENT_LOG_FILE, snapshot_dir=SNAPSHOT_DIR, db_path=None,
+                 batch_size=SYNC_BATCH_SIZE, sync_interval=SYNC_INTERVAL, snapshot_every=SNAPSHOT_EVERY):
+        self.path = path
+        self.snapshot_dir = snapshot_dir
+        self.db_path = db_path or foosboi.DB_FILE
+        self.batch_size = batch_size
+        self.sync_interval = sync_interval
+        self.snapshot_every = snapshot_every
+        self.lock = threading.Lock()
+        self.timer = None
+        self.pending = 0
+        self.snapshot_seq = latest_snapshot(snapshot_dir)[0]
+
+        segments = list_segments(path)
+        base, segment = segments[-1] if segments else (0, segment_path(path, 0))
+        if os.path.exists(segment):
+            truncate_torn_write(segment)
+        self.seq = max((event["seq"] for event in read_events(segment)), default=base)
+        self.file = open(segment, "a")
+        self.log_settings()
+
+    def append(self, command, args, timestamp=None) -> int:
+        with self.lock:
+            self.seq += 1
+            event = {"seq": self.seq, "time": timestamp or time.time(), "command": command, "args": args}
+            self.file.write(json.dumps(event) + "\n")
+            self.pending += 1
+            if self.pending >= self.batch_size:
+                self._sync()
+            elif self.timer is None:
+                self.timer = threading.Timer(self.sync_interval, self.sync)
+                self.timer.daemon = True
+                self.timer.start()
+            return self.seq
+
+    def log_settings(self):
+        self.append("configure", foosboi.trueskill_settings())
+        self.sync()
+
+    def failed(self, seq, error):
+        self.append("failed", {"seq": seq, "error": repr(error), "error_type": type(error).__name__})
+
+    def sync(self):
+        with self.lock:
+            self._sync()
+
+    def _sync(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.pending:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.pending = 0
+
+    def needs_snapshot(self) -> bool:
+        return self.seq - self.snapshot_seq >= self.snapshot_every
+
+    def write_snapshot(self):
+        """Copy the database as of the latest event. Must run between commands."""
+        self.sync()
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+        path = snapshot_path(self.snapshot_dir, self.seq)
+        tmp_path = path + ".tmp"
+        copy_database(self.db_path, tmp_path)
+        os.replace(tmp_path, path)
+        self.snapshot_seq = self.seq
+
+        with self.lock:
+            self._sync()
+            self.file.close()
+            self.file = open(segment_path(self.path, self.seq), "a")
+        self.log_settings()
+
+        snapshots = sorted(name for name in os.listdir(self.snapshot_dir) if name.endswith(".db"))
+        for name in snapshots[:-SNAPSHOTS_KEPT]:
+            os.remove(os.path.join(self.snapshot_dir, name))
+        oldest_seq = int(snapshots[-SNAPSHOTS_KEPT:][0][:-3])
+        needed = segments_from(self.path, oldest_seq)
+        for _, segment in list_segments(self.path):
+            if segment not in needed:
+                os.remove(segment)
+
+    def close(self):
+        self.sync()
+        self.file.close()
+
+
+def copy_database(source_path, target_path):
+    source, target = sqlite3.connect(source_path), sqlite3.connect(target_path)
+    try:
+        source.backup(target)
+    finally:
+        source.close()
+        target.close()
+
+
+def snapshot_path(snapshot_dir, seq):
+    return os.path.join(snapshot_dir, f"{seq:012d}.db")
+
+
+def latest_snapshot(snapshot_dir, until=None):
+    """(seq, path) of the newest snapshot, or the newest taken at or before
+    `until`; (0, None) if there is none."""
+    if not os.path.isdir(snapshot_dir):
+        return 0, None
+    snapshots = sorted(name for name in os.listdir(snapshot_dir) if name.endswith(".db"))
+    if until is not None:
+        snapshots = [name for name in snapshots if int(name[:-3]) <= until]
+    if not snapshots:
+        return 0, None
+    return int(snapshots[-1][:-3]), os.path.join(snapshot_dir, snapshots[-1])
+
+
+def segment_path(path, base):
+    return f"{path}.{base:012d}"
+
+
+def list_segments(path):
+    """(base seq, path) of every log segment, oldest first."""
+    directory, prefix = os.path.split(path)
+    directory = directory or "."
+    segments = []
+    for name in os.listdir(directory):
+        if name.startswith(prefix + ".") and name[len(prefix) + 1:].isdigit():
+            segments.append((int(name[len(prefix) + 1:]), os.path.join(directory, name)))
+    return sorted(segments)
+
+
+def segments_from(path, seq):
+    """Paths of the segments that can hold events after `seq`."""
+    segments = list_segments(path)
+    # The newest segment starting at or before seq, and everything after it
+    start = max((i for i, (base, _) in enumerate(segments) if base <= seq), default=0)
+    return [segment for _, segment in segments[start:]]
+
+
+def truncate_torn_write(path):
+    """Cut a partial line left by a crash mid-write, so new events start on
+    a line of their own."""
+    with open(path, "rb+") as f:
+        data = f.read()
+        end = data.rfind(b"\n") + 1
+        if end != len(data):
+            f.truncate(end)
+
+
+def read_events(path, after=0):
+    if not os.path.exists(path):
+        return
+    with open(path) as f:
+        line = f.readline()
+        while line:
+            next_line = f.readline()
+            try:
+                if not line.endswith("\n"):
+                    raise ValueError("unterminated line")
+                event = json.loads(line)
+            except ValueError:
+                if next_line:
+                    raise ReplayError(f"Corrupt event in {path}: {line!r}")
+                # Torn final write from a crash
+                break
+            if event["seq"] > after:
+                yield event
+            line = next_line
+
+
+def replay(db_path, log_path=EVENT_LOG_FILE, snapshot_dir=SNAPSHOT_DIR, until=None) -> foosboi.Foosboi:
+    """Rebuild the database at `db_path` from the newest snapshot at or
+    before `until` plus the events logged after it, and return a Foosboi
+    bound to it."""
+    snapshot_seq, snapshot = latest_snapshot(snapshot_dir, until)
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    if snapshot:
+        shutil.copyfile(snapshot, db_path)
+
+    engine = create_engine(f'sqlite:///{db_path}')
+    foosboi.create_tables(engine)
+    foosboi.Session.configure(bind=engine)
+
+    events = [event for segment in segments_from(log_path, snapshot_seq)
+              for event in read_events(segment, after=snapshot_seq)]
+    failed = {event["args"]["seq"]: event["args"]["error_type"]
+              for event in events if event["command"] == "failed"}
+
+    bot = foosboi.Foosboi()
+    checkpoint = db_path + ".checkpoint"
+    expected_seq = snapshot_seq + 1
+    for event in events:
+        if event["seq"] != expected_seq:
+            raise ReplayError(f"Event {expected_seq} is missing: no snapshot before it is kept "
+                              f"and the log resumes at {event['seq']}")
+        if until is not None and event["seq"] > until:
+            break
+        expected_seq += 1
+
+        if event["command"] == "failed":
+            continue
+        if event["command"] == "configure":
+            foosboi.configure_trueskill(event["args"])
+            bot.rank_index = None
+            continue
+
+        if event["seq"] in failed:
+            copy_database(db_path, checkpoint)
+        bot.command_time = event["time"]
+        try:
+            getattr(bot, event["command"])(**event["args"])
+        except Exception as e:
+            if event["seq"] not in failed:
+                raise ReplayError(f"Event {event['seq']} raised {e!r} on replay") from e
+            if failed[event["seq"]] != type(e).__name__:
+                print(f"Event {event['seq']} raised {e!r} on replay, "
+                      f"but {failed[event['seq']]} live; continuing")
+        else:
+            if event["seq"] in failed:
+                # It failed live for a reason replay can't see, like a locked
+                # database, so undo it to match what was committed
+                print(f"Event {event['seq']} failed live but succeeded on replay; skipping it")
+                engine.dispose()
+                copy_database(checkpoint, db_path)
+                bot.rank_index = None
+        finally:
+            bot.command_time = None
+            if os.path.exists(checkpoint):
+                os.remove(checkpoint)
+    return bot
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--db", required=True, help="database to rebuild; overwritten")
+    parser.add_argument("--log", default=EVENT_LOG_FILE, help="log segment prefix")
+    parser.add_argument("--snapshots", default=SNAPSHOT_DIR)
+    parser.add_argument("--until", type=int, default=None, help="stop after this event seq")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    bot = replay(args.db, args.log, args.snapshots, args.until)
+    elapsed = (time.perf_counter() - start) * 1000
+    print(f"Rebuilt {args.db} in {elapsed:.1f}ms\n")
+    print(bot.get_games())
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,44 @@
 from datetime import datetime
+import functools
+import inspect
 import itertools
+import json
 import math
+import os
 import random
+import threading
+import time
+from operator import attrgetter
 from contextlib import contextmanager
 from sqlalchemy import create_engine, Column, Integer, String, Float, ForeignKey, DateTime, and_, or_
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
 from sqlalchemy.sql import func
+from sortedcontainers import SortedList
 from typing import List
-from trueskill import Rating, rate, BETA, global_env
+from trueskill import TrueSkill
+
+
+TRUESKILL_SETTINGS_FILE = 'trueskill_settings.json'
+
+
+def load_trueskill_env(path=TRUESKILL_SETTINGS_FILE):
+    """Build the TrueSkill environment from the tuned settings written by
+    backtest.py, falling back to the library defaults."""
+    settings = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            settings = json.load(f)
+    return TrueSkill(**settings)
+
+
+def team_win_probability(env, team1, team2):
+    """Chance that team1 beats team2, given anything with mu and sigma."""
+    delta_mu = sum(r.mu for r in team1) - sum(r.mu for r in team2)
+    sum_sigma = sum(r.sigma ** 2 for r in itertools.chain(team1, team2))
+    size = len(team1) + len(team2)
+    denom = math.sqrt(size * (env.beta * env.beta) + sum_sigma)
+    return env.cdf(delta_mu / denom)
 
 
 Base = declarative_base()
@@ -54,7 +84,15 @@ def get_nth_unfinished_game(session, n):
     return query
 
 def get_all_finished_games(session, **kwargs):
-    return session.query(Game).filter(and_(Game.team1_score!=None, Game.team2_score != None)).order_by(Game.date)
+    # Ratings depend on the order results came in. Games finished before
+    # finish_seq existed have none, sort first, and fall back to date order.
+    return session.query(Game).filter(and_(Game.team1_score!=None, Game.team2_score != None)) \
+            .order_by(Game.finish_seq, Game.date, Game.id)
+
+def get_finished_results(session):
+    return get_all_finished_games(session).with_entities(
+            Game.t1p1_id, Game.t1p2_id, Game.t2p1_id, Game.t2p2_id,
+            Game.team1_score, Game.team2_score)
 
 def get_games_with_player(session, player_id):
     return get_all_finished_games(session).filter(or_(Game.team1_player1==player_id, Game.team1_player2==player_id,
@@ -90,6 +128,7 @@ class Game(Base):
     t2p2_id = Column(Integer, ForeignKey('users.id'))
     team1_score = Column(Integer)
     team2_score = Column(Integer)
+    finish_seq = Column(Integer)
 
     team1_player1 = relationship("User", foreign_keys=[t1p1_id])
     team1_player2 = relationship("User", foreign_keys=[t1p2_id])
@@ -118,46 +157,362 @@ class Game(Base):
         elif not self.team2_player2:
             self.team2_player2 = player
 
-    def shuffle(self):
+    def remove_player(self, player:User):
+        if self.team1_player1 == player:
+            self.team1_player1 = None
+        elif self.team1_player2 == player:
+            self.team1_player2 = None
+        elif self.team2_player1 == player:
+            self.team2_player1 = None
+        elif self.team2_player2 == player:
+            self.team2_player2 = None
+
+    def players(self):
+        return [self.team1_player1, self.team1_player2, self.team2_player1, self.team2_player2]
+
+    def shuffle(self, rng=random):
         players = [self.team1_player1, self.team1_player2, self.team2_player1, self.team2_player2]
-        random.shuffle(players)
+        rng.shuffle(players)
         self.team1_player1, self.team1_player2, self.team2_player1, self.team2_player2 = players
 
 
+class PlayerStats():
+    """Per-player results accumulated while replaying finished games.
+
+    Keyed by ``User.id`` so players sharing a display name don't collide.
+    """
+    __slots__ = ('player_id', 'name', 'games_played', 'games_won', 'skill', 'rank',
+                 'streak', 'longest_win_streak', 'longest_lose_streak')
+
+    def __init__(self, player_id, name):
+        self.player_id = player_id
+        self.name = name
+        self.games_played = 0
+        self.games_won = 0
+        self.skill = DEFAULT_RATING
+        self.rank = 0
+        self.streak = 0
+        self.longest_win_streak = 0
+        self.longest_lose_streak = 0
+
+    @property
+    def mu(self):
+        return self.skill.mu
+
+    @property
+    def sigma(self):
+        return self.skill.sigma
+
+    @property
+    def trueskill(self):
+        # From Wikipedia
+        # Player ranks are displayed as the conservative estimate of their skill, R = μ − 3 × σ. This is conservative, because the system is 99% sure that the player's skill is actually higher than what is displayed as their rank.
+        return self.skill.mu - (3 * self.skill.sigma)
+
+    @property
+    def win_percentage(self):
+        if not self.games_played:
+            return 0
+        return round(self.games_won / self.games_played * 100, 2)
+
+    def as_dict(self):
+        return {
+                "name": self.name,
+                "gamesPlayed": self.games_played,
+                "gamesWon": self.games_won,
+                "winPercentage": self.win_percentage,
+                "skill": self.skill,
+                "trueskill": round(self.trueskill, 2),
+                "mu": round(self.mu, 2),
+                "sigma": round(self.sigma, 2),
+                "rank": self.rank,
+                "streak": self.streak,
+                "longestWinStreak": self.longest_win_streak,
+                "longestLoseStreak": self.longest_lose_streak,
+        }
+
+
+TRUESKILL_ENV = load_trueskill_env()
+# Ratings are immutable, so every unrated player can share the same one
+DEFAULT_RATING = TRUESKILL_ENV.create_rating()
+
+
+def trueskill_settings():
+    return {"mu": TRUESKILL_ENV.mu, "sigma": TRUESKILL_ENV.sigma, "beta": TRUESKILL_ENV.beta,
+            "tau": TRUESKILL_ENV.tau, "draw_probability": TRUESKILL_ENV.draw_probability}
+
+
+def configure_trueskill(settings):
+    global TRUESKILL_ENV, DEFAULT_RATING
+    TRUESKILL_ENV = TrueSkill(**settings)
+    DEFAULT_RATING = TRUESKILL_ENV.create_rating()
+
+
+def record_result(stats, names, result):
+    """Apply one finished game, given as (t1p1, t1p2, t2p1, t2p2, team1_score,
+    team2_score) user ids and scores, to the PlayerStats in `stats`."""
+    t1p1, t1p2, t2p1, t2p2, t1score, t2score = result
+    for player in (t1p1, t1p2, t2p1, t2p2):
+        if player not in stats:
+            stats[player] = PlayerStats(player, names.get(player))
+        stats[player].games_played += 1
+
+    winners = (t1p1, t1p2) if t1score > t2score else (t2p1, t2p2)
+    losers = (t1p1, t1p2) if t1score < t2score else (t2p1, t2p2)
+
+    for winner in winners:
+        winner = stats[winner]
+        winner.games_won += 1
+        winner.streak = 1 if winner.streak < 0 else winner.streak + 1
+        if winner.streak > winner.longest_win_streak:
+            winner.longest_win_streak = winner.streak
+
+    for loser in losers:
+        loser = stats[loser]
+        loser.streak = -1 if loser.streak > 0 else loser.streak - 1
+        if -loser.streak > loser.longest_lose_streak:
+            loser.longest_lose_streak = -loser.streak
+
+    w1, w2 = stats[winners[0]], stats[winners[1]]
+    l1, l2 = stats[losers[0]], stats[losers[1]]
+    (w1.skill, w2.skill), (l1.skill, l2.skill) = TRUESKILL_ENV.rate([[w1.skill, w2.skill], [l1.skill, l2.skill]])
+
+
+class RankIndex():
+    """Players ordered by conservative TrueSkill (mu - 3*sigma).
+
+    Built once from a full replay, then kept current by recording each result
+    as it comes in, so rank lookups and top N slices are O(log n).
+    """
+    def __init__(self, stats):
+        self.lock = threading.Lock()
+        self.stats = stats
+        self.keys = {player_id: self.rank_key(player) for player_id, player in stats.items()}
+        self.order = SortedList(self.keys.values())
+
+    @staticmethod
+    def rank_key(player):
+        return (-player.trueskill, player.player_id)
+
+    def __len__(self):
+        return len(self.order)
+
+    def record(self, names, result):
+        players = result[:4]
+        with self.lock:
+            for player_id in players:
+                if player_id in self.keys:
+                    self.order.remove(self.keys[player_id])
+            record_result(self.stats, names, result)
+            for player_id in players:
+                self.keys[player_id] = self.rank_key(self.stats[player_id])
+                self.order.add(self.keys[player_id])
+
+    def rank(self, player_id):
+        """1-based rank of the player, or None if they haven't played."""
+        with self.lock:
+            if player_id not in self.keys:
+                return None
+            return self.order.index(self.keys[player_id]) + 1
+
+    def top(self, n):
+        """(rank, PlayerStats) pairs for the n best players."""
+        with self.lock:
+            return [(i+1, self.stats[player_id]) for i, (_, player_id) in enumerate(self.order[:n])]
+
+
+def event_user(user):
+    """The parts of a users_info response that commands read, as plain JSON."""
+    return {"user": {key: user["user"][key] for key in ("id", "real_name", "name")}}
+
+
+def logged_command(f):
+    """Record a state-changing command in the event log before running it.
+
+    The event is synced to disk before the command can commit anything, and
+    commands are serialized so the log order is the order they were applied
+    in. A random seed is filled in for commands that take one, and the
+    event's time is used for anything the command timestamps, so replay is
+    deterministic.
+    """
+    signature = inspect.signature(f)
+
+    @functools.wraps(f)
+    def wrapped_function(self, *args, **kwargs):
+        if self.event_log is None:
+            return f(self, *args, **kwargs)
+
+        bound = signature.bind(self, *args, **kwargs)
+        bound.apply_defaults()
+        event_args = dict(bound.arguments)
+        del event_args["self"]
+        if "seed" in event_args and event_args["seed"] is None:
+            event_args["seed"] = random.getrandbits(32)
+        if "players_info" in event_args:
+            event_args["players_info"] = [event_user(user) for user in event_args["players_info"]]
+        if "user" in event_args:
+            event_args["user"] = event_user(event_args["user"])
+
+        with self.command_lock:
+            self.command_time = time.time()
+            seq = self.event_log.append(f.__name__, event_args, self.command_time)
+            self.event_log.sync()
+            try:
+                result = f(self, **event_args)
+            except Exception as e:
+                self.event_log.failed(seq, e)
+                self.event_log.sync()
+                raise
+            if self.event_log.needs_snapshot():
+                self.event_log.write_snapshot()
+            return result
+    return wrapped_function
+
+
+def get_score_option(team1_score, team2_score):
+    score = f"{team1_score}-{team2_score}"
+    return {"text": {"type": "plain_text", "text": score}, "value": score}
+
+
 class Foosboi():
-    def __init__(self, channel=None):
+    NEW_GAME_BLOCK = {
+        "type": "section",
+        "text": {"type": "mrkdwn", "text": ":soccer: *Who's up for foosball?*"},
+    }
+    PLAYER_BLOCK = {
+        "type": "context",
+        "elements": [{"type": "mrkdwn", "text": "Join the game, or finish it with the final score."}],
+    }
+    # block_id is filled in with the game id so actions know which game they belong to
+    ACTIONS_BLOCK = {
+        "type": "actions",
+        "elements": [
+            {"type": "button", "action_id": "join_game", "style": "primary",
+             "text": {"type": "plain_text", "text": "Join"}},
+            {"type": "button", "action_id": "leave_game",
+             "text": {"type": "plain_text", "text": "Leave"}},
+            {"type": "button", "action_id": "shuffle_game",
+             "text": {"type": "plain_text", "text": "Shuffle"}},
+            {"type": "static_select", "action_id": "finish_game",
+             "placeholder": {"type": "plain_text", "text": "Finish"},
+             "options": [get_score_option(10, score) for score in range(10)] +
+                        [get_score_option(score, 10) for score in range(10)]},
+        ],
+    }
+    CANCELLED_GAME_BLOCK = {
+        "type": "section",
+        "text": {"type": "mrkdwn", "text": ":no_entry_sign: *Game cancelled*"},
+    }
+
+    def __init__(self, channel=None, event_log=None):
         self.channel = channel
+        self.event_log = event_log
+        # Set to the event time while a logged or replayed command runs
+        self.command_time = None
+        self.command_lock = threading.RLock()
         self.username = "foosbot-py"
         self.icon_emoji = ":robot_face:"
-        self.timestamp = ""
         self.pin_task_completed = False
         self.games = []
+        self.rank_index = None
+        # Held while the index is built and while results are committed, so
+        # no result can land between the build's replay and its first record
+        self.rank_index_lock = threading.RLock()
 
     @property
-    def channel():
+    def channel(self):
         return self.__channel
     
     @channel.setter
     def channel(self, channel):
         self.__channel = channel
 
-    def get_message_payload(self):
+    def get_message_payload(self, game_id:int, channel=None, ts="") -> dict:
+        with session_scope() as session:
+            game = get(session, Game, id=game_id)
+            if game is None:
+                text = "Game cancelled"
+                blocks = [self.CANCELLED_GAME_BLOCK]
+            elif game.team1_score is not None:
+                text = f"Game finished {game.team1_score}-{game.team2_score}"
+                blocks = [{"type": "section", "text": {"type": "mrkdwn", "text": f":checkered_flag: *{text}*"}},
+                          *self.get_player_block(game, odds=False)]
+            else:
+                game_num = [g.id for g in get_all_unfinished_games(session)].index(game.id)
+                text = f"Game {game_num}: {game.spaces_left()} spaces left"
+                blocks = [self.NEW_GAME_BLOCK,
+                          self.PLAYER_BLOCK,
+                          dict(self.ACTIONS_BLOCK, block_id=str(game.id)),
+                          *self.get_player_block(game, game_num)]
+
         return {
-            "ts": self.timestamp,
-            "channel": self.channel,
+            "ts": ts,
+            "channel": channel or self.channel,
             "username": self.username,
             "icon_emoji": self.icon_emoji,
-            "blocks": [self.NEW_GAME_BLOCK,
-                       self.PLAYER_BLOCK,
-                       self.ACTIONS_BLOCK,
-                       *self.get_player_block()]
+            "text": text,
+            "blocks": blocks,
         }
 
+    def get_player_block(self, game, game_num=None, odds=True):
+        def mention(player):
+            return f"<@{player.user_id}>" if player else "_open_"
+
+        team1 = f"{mention(game.team1_player1)} and {mention(game.team1_player2)}"
+        team2 = f"{mention(game.team2_player1)} and {mention(game.team2_player2)}"
+        if odds and game.spaces_left() == 0:
+            winp = round(self.win_probability(*self.get_teams_stats(game)) * 100, 1)
+            team1 += f" ({winp}%)"
+            team2 += f" ({round(100-winp, 1)}%)"
+
+        header = f"*Game {game_num}*\n" if game_num is not None else ""
+        return [{
+            "type": "section",
+            "text": {"type": "mrkdwn", "text": f"{header}{team1}\nvs.\n{team2}"},
+        }]
+
+    def get_teams_stats(self, game):
+        stats = self.stats()
+        team1 = [self.retrieve_player_stats(stats, game.team1_player1.id),
+                 self.retrieve_player_stats(stats, game.team1_player2.id)]
+        team2 = [self.retrieve_player_stats(stats, game.team2_player1.id),
+                 self.retrieve_player_stats(stats, game.team2_player2.id)]
+        return team1, team2
+
+    def get_open_game_ids(self) -> List[int]:
+        with session_scope() as session:
+            return [game.id for game in get_all_unfinished_games(session)]
+
+    def get_ready_message(self, game_id:int):
+        with session_scope() as session:
+            game = get(session, Game, id=game_id)
+            if game is None or game.spaces_left() != 0:
+                return None
+            winp = round(self.win_probability(*self.get_teams_stats(game)) * 100, 1)
+            return self.ready_message(game, winp)
+
+    def ready_message(self, game, winp):
+        return """
+                *Next game is ready to go!*
+                <@{}> and <@{}> ({}%)
+                vs.
+                <@{}> and <@{}> ({}%)
+                """.format(game.team1_player1.user_id,
+                           game.team1_player2.user_id,
+                           winp,
+                           game.team2_player1.user_id,
+                           game.team2_player2.user_id,
+                           100-winp)
+
 
+    @logged_command
     def start_game(self, players_info:List[dict]) -> str:
         users = []
         with session_scope() as session:
-            game = Game()
+            if self.command_time is not None:
+                game = Game(date=datetime.utcfromtimestamp(self.command_time))
+            else:
+                game = Game()
             session.add(game)
             self.games.append(game)
             for user in players_info:
@@ -197,7 +552,8 @@ class Foosboi():
         return message
  
 
-    def add_players(self, players_info:List[dict]) -> str:
+    @logged_command
+    def add_players(self, players_info:List[dict], game_id:int=None) -> str:
         users = []
         user = players_info[0]
 
@@ -211,30 +567,39 @@ class Foosboi():
                 users.append(user)
 
             games = get_all_unfinished_games(session)
+            if game_id is not None:
+                games = games.filter_by(id=game_id)
             message = ""
+            joined = None
             for game in games:
+                if any(user in game.players() for user in users):
+                    continue
                 if game.spaces_left() >= len(users):
                     for user in users:
                         game.add_player(user)
                         message += "{} joined the next game!\n".format(user.real_name)
+                    joined = game
                     break
 
-            if game.spaces_left() == 0:
-                winp = round(self.balance(game) * 100, 1)
-                message += """
-                *Next game is ready to go!*
-                <@{}> and <@{}> ({}%)
-                vs.
-                <@{}> and <@{}> ({}%)
-                """.format(game.team1_player1.user_id,
-                           game.team1_player2.user_id,
-                           winp,
-                           game.team2_player1.user_id,
-                           game.team2_player2.user_id,
-                           100-winp)
+            if joined is None:
+                message = "No open game has room for {}, start a new one!".format(
+                        " and ".join(user.real_name for user in users))
+            elif joined.spaces_left() == 0:
+                winp = round(self.balance(joined) * 100, 1)
+                message += self.ready_message(joined, winp)
 
             return message
 
+    @logged_command
+    def leave_game(self, user_id:str, game_id:int) -> str:
+        with session_scope() as session:
+            game = get(session, Game, id=game_id)
+            player = get(session, User, user_id=user_id)
+            if game is None or player is None or player not in game.players():
+                return ""
+            game.remove_player(player)
+            return f"{player} left the game"
+
     def balance(self, game):
         stats = self.stats()
         orders = [[0,1,2,3], [0,2,1,3], [0,3,1,2]]
@@ -242,10 +607,10 @@ class Foosboi():
         players = [game.team1_player1, game.team1_player2, game.team2_player1, game.team2_player2]
 
         for i, order in enumerate(orders):
-            p1 = self.retrieve_player_stats(stats, players[order[0]].name)
-            p2 = self.retrieve_player_stats(stats, players[order[1]].name)
-            p3 = self.retrieve_player_stats(stats, players[order[2]].name)
-            p4 = self.retrieve_player_stats(stats, players[order[3]].name)
+            p1 = self.retrieve_player_stats(stats, players[order[0]].id)
+            p2 = self.retrieve_player_stats(stats, players[order[1]].id)
+            p3 = self.retrieve_player_stats(stats, players[order[2]].id)
+            p4 = self.retrieve_player_stats(stats, players[order[3]].id)
             percentages[i] = self.win_probability([p1,p2], [p3,p4])
 
         closest = 0
@@ -264,13 +629,17 @@ class Foosboi():
         return percentages[closest]
 
 
-    def shuffle(self, game_num=0):
+    @logged_command
+    def shuffle(self, game_num=0, game_id:int=None, seed:int=None):
         with session_scope() as session:
-            game = get_all_unfinished_games(session)[game_num]
-            game.shuffle()
-            rankings = self.stats()
-            team1 = [rankings[game.team1_player1.name], rankings[game.team1_player2.name]]
-            team2 = [rankings[game.team2_player1.name], rankings[game.team2_player2.name]]
+            if game_id is not None:
+                game = get(session, Game, id=game_id)
+            else:
+                game = get_all_unfinished_games(session)[game_num]
+            if game is None or game.spaces_left() != 0:
+                return "Game isn't full yet!"
+            game.shuffle(random.Random(seed))
+            team1, team2 = self.get_teams_stats(game)
             winp = round(self.win_probability(team1, team2) * 100, 1)
             message = """
                 *Shuffled Teams!*
@@ -289,14 +658,10 @@ class Foosboi():
 
     
     def win_probability(self, team1, team2):
-        delta_mu = sum(r['mu'] for r in team1) - sum(r['mu'] for r in team2)
-        sum_sigma = sum(r['sigma'] ** 2 for r in itertools.chain(team1, team2))
-        size = len(team1) + len(team2)
-        denom = math.sqrt(size * (BETA * BETA) + sum_sigma)
-        ts = global_env()
-        return ts.cdf(delta_mu / denom)
+        return team_win_probability(TRUESKILL_ENV, team1, team2)
 
 
+    @logged_command
     def cancel_game(self, game_num:int):
         with session_scope() as session:
             game = get_all_unfinished_games(session)[game_num]
@@ -304,6 +669,7 @@ class Foosboi():
 
         return f"Game {game_num} cancelled!"
 
+    @logged_command
     def cancel_all_games(self):
         with session_scope() as session:
             get_all_unfinished_games(session).delete()
@@ -311,13 +677,25 @@ class Foosboi():
         return f"All games cancelled!"
 
 
-    def finish_game(self, team1_score:int, team2_score:int):
+    @logged_command
+    def finish_game(self, team1_score:int, team2_score:int, game_id:int=None):
         with session_scope() as session:
-            game = get_first_unfinished_game(session)
-            game.team1_score = team1_score
-            game.team2_score = team2_score
-
-            session.commit()
+            if game_id is not None:
+                game = get(session, Game, id=game_id)
+            else:
+                game = get_all_unfinished_games(session).first()
+            if game is None or game.team1_score is not None or game.spaces_left() != 0:
+                return "Game isn't ready to finish!"
+            with self.rank_index_lock:
+                game.team1_score = team1_score
+                game.team2_score = team2_score
+                game.finish_seq = (session.query(func.max(Game.finish_seq)).scalar() or 0) + 1
+                session.commit()
+
+                if self.rank_index is not None:
+                    players = game.players()
+                    self.rank_index.record({player.id: player.name for player in players},
+                                           (*(player.id for player in players), team1_score, team2_score))
 
             message = "Results saved\n" 
             if team1_score > team2_score:
@@ -329,82 +707,18 @@ class Foosboi():
 
         return message
 
-    def retrieve_player_stats(self, stats, player):
-        if player in stats:
-            return stats[player]
-
-        return {
-                "gamesPlayed": 0,
-                "gamesWon": 0,
-                "winPercentage": 0,
-                "skill": Rating(),
-                "mu": 0,
-                "sigma": 0,
-                "rank": 2,
-                "streak": 0,
-                "longestWinStreak": 0,
-                "longestLoseStreak": 0,
-        }
+    def retrieve_player_stats(self, stats, player_id):
+        if player_id in stats:
+            return stats[player_id]
+        return PlayerStats(player_id, None)
 
     def stats(self):
         stats = {}
 
         with session_scope() as session:
-            finished_games = get_all_finished_games(session)
-
-            for game in finished_games:
-                t1p1 = game.team1_player1.name
-                t1p2 = game.team1_player2.name
-                t2p1 = game.team2_player2.name
-                t2p2 = game.team2_player2.name
-
-                t1score = game.team1_score
-                t2score = game.team2_score
-
-                all_players = [t1p1, t1p2, t2p1, t2p2]
-
-                for player in all_players:
-                    stats[player] = self.retrieve_player_stats(stats, player)
-                    stats[player]['gamesPlayed'] += 1
-                    stats[player]['rank'] = 2
-
-                winners = [t1p1, t1p2] if t1score > t2score else [t2p1, t2p2]
-                losers = [t1p1, t1p2] if t1score < t2score else [t2p1, t2p2]
-
-                for winner in winners:
-                    stats[winner]['gamesWon'] += 1
-                    stats[winner]['rank'] = 1
-
-                    stats[winner]['streak'] = 1 if stats[winner]['streak'] < 0 else stats[winner]['streak'] + 1
-                    if stats[winner]['streak'] > stats[winner]['longestWinStreak']:
-                        stats[winner]['longestWinStreak'] = stats[winner]['streak']
-
-                for loser in losers:
-                    stats[loser]['streak'] = -1 if stats[loser]['streak'] > 0 else stats[loser]['streak'] - 1
-                    if -stats[loser]['streak'] > stats[loser]['longestLoseStreak']:
-                        stats[loser]['longestLoseStreak'] = -stats[loser]['streak']
-
-
-                # TODO: trueskill adjust
-                w1 = stats[winners[0]]['skill']
-                w2 = stats[winners[1]]['skill']
-                l1 = stats[losers[0]]['skill']
-                l2 = stats[losers[1]]['skill']
-                (w1, w2),(l1,l2) = rate([[w1,w2], [l1,l2]])
-                stats[winners[0]]['skill'] = w1
-                stats[winners[1]]['skill'] = w2
-                stats[losers[0]]['skill'] = l1
-                stats[losers[1]]['skill'] = l2
-            for player in stats.keys():
-                stats[player]['name'] = player
-                stats[player]['winPercentage'] = round(stats[player]['gamesWon'] / stats[player]['gamesPlayed'] * 100, 2)
-                stats[player]['trueskill'] = round(stats[player]['skill'].mu - (3 * stats[player]['skill'].sigma), 2)
-                # From Wikipedia
-                # Player ranks are displayed as the conservative estimate of their skill, R = μ − 3 × σ. This is conservative, because the system is 99% sure that the player's skill is actually higher than what is displayed as their rank.
-
-
-                stats[player]['mu'] = round(stats[player]['skill'].mu, 2)
-                stats[player]['sigma'] = round(stats[player]['skill'].sigma, 2)
+            names = dict(session.query(User.id, User.name))
+            for result in get_finished_results(session):
+                record_result(stats, names, result)
 
             return stats
 
@@ -413,13 +727,34 @@ class Foosboi():
 
         # remove retirees
 
-        rankings = sorted(stats.items(), key=lambda player_stat: player_stat[1]['trueskill'], reverse=True)
+        rankings = sorted(stats.values(), key=attrgetter('trueskill'), reverse=True)
 
         for i, player in enumerate(rankings):
-            player[1]['rank'] = str(i+1)
+            player.rank = i+1
 
         return rankings
 
+    def get_rank_index(self):
+        with self.rank_index_lock:
+            if self.rank_index is None:
+                self.rank_index = RankIndex(self.stats())
+            return self.rank_index
+
+    def get_rank(self, user) -> str:
+        with session_scope() as session:
+            player = get(session,
+                    User,
+                    user_id=user["user"]["id"])
+            if player is None:
+                return f"{user['user']['real_name']} hasn't played yet"
+
+            rank_index = self.get_rank_index()
+            rank = rank_index.rank(player.id)
+            if rank is None:
+                return f"{player} hasn't played yet"
+            trueskill = round(rank_index.stats[player.id].trueskill, 2)
+            return f"{player} is ranked {rank} of {len(rank_index)} ({trueskill})"
+
     def noopFormat(self, s): return s
     def trueSkillFormat(self, s): return s
     def percentFormat(self, s): return "{}%    ".format(s)
@@ -456,8 +791,14 @@ class Foosboi():
             lines[2+i] += field_value
 
     def print_stats(self):
+        return self.format_rankings([(player.rank, player) for player in self.get_rankings()])
+
+    def print_top(self, n:int):
+        return self.format_rankings(self.get_rank_index().top(max(n, 1)))
+
+    def format_rankings(self, ranked_players):
         with session_scope() as session:
-            rankings = self.get_rankings()
+            rankings = [(player.name, dict(player.as_dict(), rank=rank)) for rank, player in ranked_players]
 
             response_list = [''] * (len(rankings)+2)
             self.add_column(response_list, rankings, "Rank", "rank", self.noopFormat, True)
@@ -486,7 +827,9 @@ class Foosboi():
 
     def history(self, player_name:str, num_games:int):
         with session_scope() as session:
-            player = get_or_create(session, User, name=player_name)
+            player = get(session, User, name=player_name)
+            if player is None:
+                return f"No games found for {player_name}"
             games = get_games_with_player(session, player_id=player)[:num_games]
             msg = ""
             for game in games:
@@ -503,6 +846,7 @@ class Foosboi():
             msg = f"{player} has {balance} fooscoin left"
             return msg
         
+    @logged_command
     def rebuy(self, user:str) -> str:
         with session_scope() as session:
             player = get(session, 
@@ -517,6 +861,15 @@ class Foosboi():
  
 
 
-engine = create_engine('sqlite:///foosboi.db', echo=True)
-Base.metadata.create_all(engine)
+def create_tables(engine):
+    Base.metadata.create_all(engine)
+    # create_all doesn't add columns to existing tables
+    columns = [row[1] for row in engine.execute("PRAGMA table_info(games)")]
+    if 'finish_seq' not in columns:
+        engine.execute("ALTER TABLE games ADD COLUMN finish_seq INTEGER")
+
+
+DB_FILE = os.environ.get('FOOSBOI_DB', 'foosboi.db')
+engine = create_engine(f'sqlite:///{DB_FILE}', echo=True)
+create_tables(engine)
 Session = sessionmaker(bind=engine)
@@ -1 +1,2 @@
 SLACK_BOT_TOKEN='xoxb-<FILL ME>'
+SLACK_SIGNING_SECRET='<FILL ME>'
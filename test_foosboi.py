@@ -0,0 +1,196 @@
+import os
+import tempfile
+
+# Keep the module-level engine away from the real database
+os.environ.setdefault("FOOSBOI_DB", os.path.join(tempfile.mkdtemp(), "foosboi.db"))
+
+import pytest
+from sqlalchemy import create_engine
+
+import eventlog
+import foosboi
+
+
+def user(i):
+    return {"user": {"id": f"U{i}", "real_name": f"Player {i}", "name": f"player{i}"}}
+
+
+def use_database(path):
+    engine = create_engine(f"sqlite:///{path}")
+    foosboi.create_tables(engine)
+    foosboi.Session.configure(bind=engine)
+    return engine
+
+
+@pytest.fixture
+def bot(tmp_path):
+    use_database(tmp_path / "foosboi.db")
+    return foosboi.Foosboi()
+
+
+def open_game(bot, players):
+    bot.start_game([user(players[0])])
+    game_id = bot.get_open_game_ids()[-1]
+    bot.add_players([user(i) for i in players[1:]], game_id=game_id)
+    return game_id
+
+
+def ranking(players):
+    return [(player.player_id, round(player.trueskill, 6)) for player in players]
+
+
+def test_rank_index_matches_rebuild_when_games_finish_out_of_order(bot):
+    bot.finish_game(10, 4, game_id=open_game(bot, [0, 1, 2, 3]))
+    bot.get_rank_index()
+
+    older = open_game(bot, [0, 4, 5, 6])
+    newer = open_game(bot, [5, 1, 2, 6])
+    bot.finish_game(10, 3, game_id=newer)
+    bot.finish_game(2, 10, game_id=older)
+
+    rebuilt = foosboi.RankIndex(bot.stats())
+    assert ranking(p for _, p in bot.get_rank_index().top(10)) == ranking(p for _, p in rebuilt.top(10))
+    assert ranking(bot.get_rankings()) == ranking(p for _, p in rebuilt.top(10))
+
+
+def test_rank_lookup(bot):
+    bot.finish_game(10, 4, game_id=open_game(bot, [0, 1, 2, 3]))
+
+    assert bot.get_rank(user(0)).startswith("Player 0 is ranked 1 of 4")
+    assert bot.get_rank(user(9)) == "Player 9 hasn't played yet"
+
+
+def test_top_clamps_to_at_least_one_player(bot):
+    bot.finish_game(10, 4, game_id=open_game(bot, [0, 1, 2, 3]))
+
+    table = bot.print_top(-3)
+    assert "player" in table
+    assert len([line for line in table.splitlines() if line.startswith(("1 ", "2 ", "3 ", "4 "))]) == 1
+
+
+@pytest.fixture
+def logged_bot(tmp_path):
+    settings = foosboi.trueskill_settings()
+    db_path = str(tmp_path / "foosboi.db")
+    use_database(db_path)
+    log = eventlog.EventLog(path=str(tmp_path / "foosboi.events"), snapshot_dir=str(tmp_path / "snapshots"),
+                            db_path=db_path, snapshot_every=7)
+    yield foosboi.Foosboi(event_log=log)
+    log.close()
+    foosboi.configure_trueskill(settings)
+
+
+def play(bot, games):
+    for g in range(games):
+        bot.start_game([user(0)])
+        bot.add_players([user(1), user(2), user(3)] if g % 2 else [user(1), user(4), user(5)])
+        bot.shuffle(0)
+        bot.finish_game(10, g)
+
+
+def state(bot):
+    with foosboi.session_scope() as session:
+        games = [(game.id, game.date, game.t1p1_id, game.t1p2_id, game.t2p1_id, game.t2p2_id,
+                  game.team1_score, game.team2_score) for game in session.query(foosboi.Game)]
+        users = [(u.id, u.user_id) for u in session.query(foosboi.User)]
+    return games, users, ranking(bot.get_rankings())
+
+
+def replay(tmp_path, until=None):
+    return eventlog.replay(str(tmp_path / "replayed.db"), str(tmp_path / "foosboi.events"),
+                           str(tmp_path / "snapshots"), until=until)
+
+
+def test_replay_matches_live(logged_bot, tmp_path):
+    play(logged_bot, 4)
+    with pytest.raises(IndexError):
+        logged_bot.cancel_game(7)
+    logged_bot.start_game([user(3)])
+    live = state(logged_bot)
+    logged_bot.event_log.close()
+
+    assert eventlog.latest_snapshot(str(tmp_path / "snapshots"))[0] > 0
+    assert state(replay(tmp_path)) == live
+
+
+def test_replay_until_starts_from_an_older_snapshot(logged_bot, tmp_path):
+    play(logged_bot, 2)
+    until = logged_bot.event_log.seq
+    at_until = state(logged_bot)
+    play(logged_bot, 2)
+    logged_bot.event_log.close()
+
+    assert eventlog.latest_snapshot(str(tmp_path / "snapshots"))[0] > until
+    assert state(replay(tmp_path, until=until)) == at_until
+
+
+def test_replay_until_before_every_kept_snapshot_raises(logged_bot, tmp_path):
+    play(logged_bot, 8)
+    logged_bot.event_log.close()
+
+    with pytest.raises(eventlog.ReplayError):
+        replay(tmp_path, until=3)
+
+
+def test_torn_write_is_cut_on_restart(logged_bot, tmp_path):
+    play(logged_bot, 1)
+    logged_bot.event_log.close()
+    segment = eventlog.list_segments(str(tmp_path / "foosboi.events"))[-1][1]
+    with open(segment, "a") as f:
+        f.write('{"seq": 99, "comm')
+
+    logged_bot.event_log = eventlog.EventLog(path=str(tmp_path / "foosboi.events"),
+                                             snapshot_dir=str(tmp_path / "snapshots"),
+                                             db_path=logged_bot.event_log.db_path, snapshot_every=7)
+    play(logged_bot, 1)
+    live = state(logged_bot)
+    seq = logged_bot.event_log.seq
+    logged_bot.event_log.close()
+
+    events = list(eventlog.read_events(eventlog.list_segments(str(tmp_path / "foosboi.events"))[-1][1]))
+    assert events[-1]["seq"] == seq
+    assert state(replay(tmp_path)) == live
+
+
+def test_corrupt_line_before_the_end_raises(tmp_path):
+    path = tmp_path / "foosboi.events.000000000000"
+    path.write_text('garbage\n{"seq": 1}\n')
+
+    with pytest.raises(eventlog.ReplayError):
+        list(eventlog.read_events(str(path)))
+
+
+def test_command_that_failed_live_but_succeeds_on_replay_is_skipped(logged_bot, tmp_path):
+    play(logged_bot, 1)
+    logged_bot.start_game([user(0)])
+    log = logged_bot.event_log
+    log.failed(log.append("cancel_all_games", {}), RuntimeError("database is locked"))
+    live = state(logged_bot)
+    log.close()
+
+    assert state(replay(tmp_path)) == live
+
+
+def test_replay_uses_logged_trueskill_settings(tmp_path):
+    settings = foosboi.trueskill_settings()
+    foosboi.configure_trueskill(dict(settings, beta=1.0, tau=0.5))
+    try:
+        db_path = str(tmp_path / "foosboi.db")
+        use_database(db_path)
+        log = eventlog.EventLog(path=str(tmp_path / "foosboi.events"), snapshot_dir=str(tmp_path / "snapshots"),
+                                db_path=db_path)
+        bot = foosboi.Foosboi(event_log=log)
+        play(bot, 3)
+        live = state(bot)
+        log.close()
+
+        foosboi.configure_trueskill(settings)
+        assert state(replay(tmp_path)) == live
+    finally:
+        foosboi.configure_trueskill(settings)
+
+
+def test_history_does_not_create_users(bot):
+    assert bot.history("nobody", 5) == "No games found for nobody"
+    with foosboi.session_scope() as session:
+        assert session.query(foosboi.User).count() == 0